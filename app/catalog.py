@@ -0,0 +1,390 @@
+"""
+SQLite metadata catalog for notes stored in DATA_DIR
+"""
+
+import hashlib
+import json
+import os
+import posixpath
+import re
+import sqlite3
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+from urllib.parse import unquote
+
+# Add util to path for importing
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from util.paths import get_data_dir
+
+from app.config import (
+    ALLOWED_EXTENSIONS, MARKDOWN_EXTENSIONS, CATALOG_FILE,
+    CATALOG_RECONCILE_INTERVAL, RECENT_FILES_LIMIT
+)
+
+DATA_DIR = get_data_dir()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    dir TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    hash TEXT NOT NULL,
+    title TEXT,
+    headings TEXT NOT NULL DEFAULT '[]'
+);
+CREATE INDEX IF NOT EXISTS idx_files_name ON files(name);
+CREATE INDEX IF NOT EXISTS idx_files_mtime ON files(mtime DESC);
+
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    dir TEXT NOT NULL,
+    name TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS tags (
+    path TEXT NOT NULL,
+    tag TEXT NOT NULL,
+    PRIMARY KEY (path, tag)
+);
+CREATE INDEX IF NOT EXISTS idx_tags_tag ON tags(tag);
+
+CREATE TABLE IF NOT EXISTS links (
+    source TEXT NOT NULL,
+    target TEXT NOT NULL,
+    PRIMARY KEY (source, target)
+);
+CREATE INDEX IF NOT EXISTS idx_links_target ON links(target);
+"""
+
+FENCE_RE = re.compile(r'^ {0,3}(`{3,}|~{3,})(.*)$')
+INDENTED_CODE_RE = re.compile(r'^(?: {4}|\t)')
+HEADING_RE = re.compile(r'^(#{1,6})\s+(.+?)\s*#*\s*$')
+INLINE_CODE_RE = re.compile(r'`[^`]*`')
+LINK_RE = re.compile(r'!?\[[^\]]*\]\(\s*<?([^)\s>]+)>?(?:\s+"[^"]*")?\s*\)')
+LINK_DEF_RE = re.compile(r'^\s{0,3}\[[^\]]+\]:\s*<?(\S+?)>?(?:\s+"[^"]*")?\s*$')
+HASHTAG_RE = re.compile(r'(?<![\w#&/])#([A-Za-z][\w/-]*)')
+SCHEME_RE = re.compile(r'^[A-Za-z][A-Za-z0-9+.-]*:')
+# '#fff' or '#1e293b' in prose is a colour, not a tag
+HEX_COLOR_RE = re.compile(r'^(?:[0-9a-f]{3,4}|[0-9a-f]{6}|[0-9a-f]{8})$', re.IGNORECASE)
+
+_last_reconcile = 0.0
+
+
+@contextmanager
+def _connect() -> Iterator[sqlite3.Connection]:
+    """Open a catalog connection, committing on success"""
+    conn = sqlite3.connect(CATALOG_FILE, timeout=10)
+    conn.row_factory = sqlite3.Row
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def normalize_path(rel_path: str) -> str:
+    """Normalize a DATA_DIR relative path to the catalog's posix form"""
+    return posixpath.normpath(rel_path.replace('\\', '/')).lstrip('/')
+
+
+def is_tracked(rel_path: str) -> bool:
+    """Check if a relative path is a note the catalog keeps track of"""
+    parts = rel_path.split('/')
+    return (Path(rel_path).suffix.lower() in ALLOWED_EXTENSIONS
+            and not any(part.startswith('.') or part == '..' for part in parts[:-1]))
+
+
+def _parse_front_matter(lines: list[str]) -> tuple[dict[str, str | list[str]], int]:
+    """Parse a leading '---' YAML-style block into simple key/value pairs"""
+    if not lines or lines[0].strip() != '---':
+        return {}, 0
+
+    meta: dict[str, str | list[str]] = {}
+    key = None
+    for i, line in enumerate(lines[1:], start=1):
+        stripped = line.strip()
+        if stripped in ('---', '...'):
+            return meta, i + 1
+        if stripped.startswith('- ') and key is not None:
+            items = meta[key] if isinstance(meta[key], list) else []
+            items.append(stripped[2:].strip())
+            meta[key] = items
+        elif ':' in line and not line[0].isspace():
+            key, value = line.split(':', 1)
+            key = key.strip().lower()
+            meta[key] = value.strip()
+    return {}, 0
+
+
+def _split_tags(value: str | list[str]) -> list[str]:
+    """Split a front-matter tags value into individual tags"""
+    if isinstance(value, str):
+        value = value.strip('[]').split(',')
+    return [tag.strip().strip('\'"').lstrip('#').lower() for tag in value]
+
+
+def resolve_link(source: str, target: str) -> str | None:
+    """Resolve a link target found in source to a DATA_DIR relative note path"""
+    if target.startswith('/view/'):
+        target = target[len('/view/'):]
+    elif target.startswith(('#', '/')) or SCHEME_RE.match(target):
+        return None
+
+    target = unquote(target.split('#', 1)[0].split('?', 1)[0])
+    if not target:
+        return None
+
+    resolved = normalize_path(posixpath.join(posixpath.dirname(source), target))
+    if resolved.startswith('..') or Path(resolved).suffix.lower() not in ALLOWED_EXTENSIONS:
+        return None
+    return resolved
+
+
+def extract_metadata(rel_path: str, content: str) -> dict:
+    """Extract title, headings, tags and outbound links from note content"""
+    meta = {'title': None, 'headings': [], 'tags': set(), 'links': set()}
+    if Path(rel_path).suffix.lower() not in MARKDOWN_EXTENSIONS:
+        return meta
+
+    lines = content.splitlines()
+    front_matter, body_start = _parse_front_matter(lines)
+    if front_matter.get('title'):
+        meta['title'] = str(front_matter['title']).strip('\'"')
+    if front_matter.get('tags'):
+        meta['tags'].update(tag for tag in _split_tags(front_matter['tags']) if tag)
+
+    fence = None
+    indented_code = False
+    previous_blank = True
+    for line in lines[body_start:]:
+        marker = FENCE_RE.match(line)
+        if fence:
+            # Only a bare fence of the same character and at least the same length closes it
+            if marker and marker.group(1)[0] == fence[0] and len(marker.group(1)) >= len(fence) \
+                    and not marker.group(2).strip():
+                fence = None
+            continue
+        if marker and not (marker.group(1)[0] == '`' and '`' in marker.group(2)):
+            fence = marker.group(1)
+            continue
+
+        if not line.strip():
+            previous_blank = True
+            continue
+        if INDENTED_CODE_RE.match(line) and (previous_blank or indented_code):
+            indented_code = True
+            continue
+        indented_code = False
+        previous_blank = False
+
+        heading = HEADING_RE.match(line)
+        if heading:
+            meta['headings'].append({'level': len(heading.group(1)), 'text': heading.group(2)})
+
+        line = INLINE_CODE_RE.sub('', line)
+        targets = LINK_RE.findall(line)
+        link_def = LINK_DEF_RE.match(line)
+        if link_def:
+            targets.append(link_def.group(1))
+        for target in targets:
+            resolved = resolve_link(rel_path, target)
+            if resolved and resolved != rel_path:
+                meta['links'].add(resolved)
+
+        if not heading:
+            meta['tags'].update(tag.lower() for tag in HASHTAG_RE.findall(LINK_RE.sub('', line))
+                                if not HEX_COLOR_RE.match(tag))
+
+    if meta['title'] is None and meta['headings']:
+        meta['title'] = meta['headings'][0]['text']
+    return meta
+
+
+def _delete(conn: sqlite3.Connection, rel_path: str) -> None:
+    """Remove all catalog rows belonging to a file"""
+    conn.execute('DELETE FROM files WHERE path = ?', (rel_path,))
+    conn.execute('DELETE FROM tags WHERE path = ?', (rel_path,))
+    conn.execute('DELETE FROM links WHERE source = ?', (rel_path,))
+
+
+def _build_entry(rel_path: str, stat: os.stat_result, data: bytes) -> dict:
+    """Build the catalog entry of a file from its stat result and raw content"""
+    try:
+        meta = extract_metadata(rel_path, data.decode('utf-8'))
+    except UnicodeDecodeError:
+        meta = extract_metadata(rel_path, '')
+    return {**meta, 'path': rel_path, 'size': stat.st_size, 'mtime': stat.st_mtime,
+            'hash': hashlib.sha256(data).hexdigest()}
+
+
+def _write_entry(conn: sqlite3.Connection, entry: dict) -> None:
+    """Replace the catalog rows of a file with a built entry"""
+    rel_path = entry['path']
+    _delete(conn, rel_path)
+    conn.execute(
+        'INSERT INTO files (path, dir, name, size, mtime, hash, title, headings) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        (rel_path, posixpath.dirname(rel_path), posixpath.basename(rel_path),
+         entry['size'], entry['mtime'], entry['hash'],
+         entry['title'], json.dumps(entry['headings'], ensure_ascii=False))
+    )
+    conn.executemany('INSERT INTO tags (path, tag) VALUES (?, ?)',
+                     [(rel_path, tag) for tag in entry['tags']])
+    conn.executemany('INSERT INTO links (source, target) VALUES (?, ?)',
+                     [(rel_path, target) for target in entry['links']])
+
+
+def update_file(rel_path: str) -> None:
+    """Refresh the catalog entry of a single file after it was written"""
+    rel_path = normalize_path(rel_path)
+    if not is_tracked(rel_path):
+        return
+
+    file_path = DATA_DIR / rel_path
+    entry = _build_entry(rel_path, file_path.stat(), file_path.read_bytes())
+    with _connect() as conn:
+        _write_entry(conn, entry)
+        directory = posixpath.dirname(rel_path)
+        while directory:
+            conn.execute('INSERT OR IGNORE INTO directories (path, dir, name) VALUES (?, ?, ?)',
+                         (directory, posixpath.dirname(directory), posixpath.basename(directory)))
+            directory = posixpath.dirname(directory)
+
+
+def remove_file(rel_path: str) -> None:
+    """Drop a deleted file from the catalog"""
+    with _connect() as conn:
+        _delete(conn, normalize_path(rel_path))
+
+
+def reconcile() -> None:
+    """Sync the catalog with DATA_DIR, re-reading only files whose size or mtime changed"""
+    global _last_reconcile
+
+    # Walk and read without holding the write lock, so saves are never blocked by a scan
+    known = {row['path']: (row['size'], row['mtime'])
+             for row in _query('SELECT path, size, mtime FROM files')}
+    known_directories = {row['path'] for row in _query('SELECT path FROM directories')}
+    seen_files = set()
+    directories = []
+    entries = []
+
+    for dirpath, dirnames, filenames in os.walk(DATA_DIR):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+        rel_dir = Path(dirpath).relative_to(DATA_DIR).as_posix()
+        rel_dir = '' if rel_dir == '.' else rel_dir
+
+        for name in dirnames:
+            directories.append((posixpath.join(rel_dir, name), rel_dir, name))
+
+        for name in filenames:
+            if Path(name).suffix.lower() not in ALLOWED_EXTENSIONS:
+                continue
+            rel_path = posixpath.join(rel_dir, name)
+            file_path = Path(dirpath) / name
+            try:
+                stat = file_path.stat()
+                seen_files.add(rel_path)
+                if known.get(rel_path) != (stat.st_size, stat.st_mtime):
+                    entries.append(_build_entry(rel_path, stat, file_path.read_bytes()))
+            except OSError:
+                continue
+
+    with _connect() as conn:
+        def unchanged_since_scan(rel_path: str) -> bool:
+            # A write route may have refreshed the row while we were scanning
+            row = conn.execute('SELECT size, mtime FROM files WHERE path = ?', (rel_path,)).fetchone()
+            return (tuple(row) if row else None) == known.get(rel_path)
+
+        for entry in entries:
+            if unchanged_since_scan(entry['path']):
+                _write_entry(conn, entry)
+        for rel_path in known.keys() - seen_files:
+            if unchanged_since_scan(rel_path):
+                _delete(conn, rel_path)
+        conn.executemany('DELETE FROM directories WHERE path = ?',
+                         [(path,) for path in known_directories - {d[0] for d in directories}])
+        conn.executemany('INSERT OR IGNORE INTO directories (path, dir, name) VALUES (?, ?, ?)',
+                         directories)
+
+    _last_reconcile = time.monotonic()
+
+
+def reconcile_if_stale() -> None:
+    """Rescan DATA_DIR when the last reconciliation is older than the configured interval"""
+    if time.monotonic() - _last_reconcile >= CATALOG_RECONCILE_INTERVAL:
+        reconcile()
+
+
+def init_catalog() -> None:
+    """Create the catalog schema and populate it from DATA_DIR"""
+    CATALOG_FILE.parent.mkdir(parents=True, exist_ok=True)
+    with _connect() as conn:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(SCHEMA)
+    reconcile()
+
+
+def get_file_tree() -> list[dict]:
+    """Get file tree structure from the catalog"""
+    rows = _query(
+        "SELECT 'directory' AS type, path, dir, name, 0 AS size FROM directories "
+        "UNION ALL SELECT 'file', path, dir, name, size FROM files ORDER BY name"
+    )
+    children: dict[str, list[dict]] = {'': []}
+    for row in rows:
+        if row['type'] == 'file':
+            item = {'type': 'file', 'name': row['name'], 'path': row['path'], 'size': row['size']}
+        else:
+            item = {'type': 'directory', 'name': row['name'], 'path': row['path'],
+                    'children': children.setdefault(row['path'], [])}
+        children.setdefault(row['dir'], []).append(item)
+    return children['']
+
+
+def recent_files(limit: int = RECENT_FILES_LIMIT) -> list[dict]:
+    """Get the most recently modified files"""
+    return _query('SELECT path, name, title, mtime FROM files ORDER BY mtime DESC LIMIT ?', (limit,))
+
+
+def files_with_tag(tag: str) -> list[dict]:
+    """Get all files carrying a tag"""
+    return _query(
+        'SELECT f.path, f.name, f.title FROM tags t JOIN files f ON f.path = t.path '
+        'WHERE t.tag = ? ORDER BY f.path',
+        (tag.lower(),)
+    )
+
+
+def file_tags(rel_path: str) -> list[str]:
+    """Get the tags of a single file"""
+    rows = _query('SELECT tag FROM tags WHERE path = ? ORDER BY tag', (normalize_path(rel_path),))
+    return [row['tag'] for row in rows]
+
+
+def backlinks(rel_path: str) -> list[dict]:
+    """Get the files linking to a file, using the reverse link index"""
+    return _query(
+        'SELECT f.path, f.name, f.title FROM links l JOIN files f ON f.path = l.source '
+        'WHERE l.target = ? ORDER BY f.path',
+        (normalize_path(rel_path),)
+    )
+
+
+def broken_links() -> list[dict]:
+    """Get all links whose target file does not exist"""
+    return _query(
+        'SELECT l.source, l.target FROM links l LEFT JOIN files f ON f.path = l.target '
+        'WHERE f.path IS NULL ORDER BY l.source, l.target'
+    )
+
+
+def _query(sql: str, params: tuple = ()) -> list[dict]:
+    """Run a read query and return rows as dicts"""
+    with _connect() as conn:
+        return [dict(row) for row in conn.execute(sql, params)]
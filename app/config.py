@@ -10,7 +10,7 @@ from dotenv import load_dotenv
 # Add util to path for importing
 sys.path.insert(0, str(Path(__file__).parent.parent))
 from util.paths import (
-    get_project_root, get_config_dir, get_data_dir, 
+    get_project_root, get_config_dir, get_data_dir, get_meta_dir,
     get_templates_dir, get_static_dir, get_users_config_file
 )
 
@@ -24,6 +24,7 @@ if env_file.exists():
 BASE_DIR = get_project_root()
 CONFIG_DIR = get_config_dir()
 DATA_DIR = get_data_dir()
+META_DIR = get_meta_dir()
 TEMPLATES_DIR = get_templates_dir()
 STATIC_DIR = get_static_dir()
 
@@ -37,7 +38,23 @@ PORT = int(os.getenv("PORT", "5000"))
 
 # File settings
 ALLOWED_EXTENSIONS = {'.txt', '.md', '.markdown'}
+MARKDOWN_EXTENSIONS = {'.md', '.markdown'}
+MARKDOWN_EXTRAS = ['fenced-code-blocks', 'tables', 'code-friendly']
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
+PATCH_INPLACE_MAX_TAIL = 64 * 1024  # Patch saves rewrite larger tails atomically
+FILE_LOCK_DIR = META_DIR / "locks"  # One lock file per note path, shared by all workers
+
+# Metadata catalog settings
+CATALOG_FILE = META_DIR / "catalog.db"
+CATALOG_RECONCILE_INTERVAL = 60  # Rescan DATA_DIR at most once per minute
+RECENT_FILES_LIMIT = 10
+
+# Live preview settings
+RENDER_CACHE_SIZE = 4096  # Rendered Markdown blocks kept in memory
+
+# Revision history settings
+REVISIONS_FILE = META_DIR / "revisions.db"
+REVISION_SNAPSHOT_INTERVAL = 16  # Store a full snapshot after this many chained deltas
 
 # Security settings
 SESSION_TIMEOUT = 24 * 60 * 60  # 24 hours in seconds
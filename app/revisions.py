@@ -0,0 +1,202 @@
+"""
+Content-addressed revision history for notes, stored as compressed deltas
+"""
+
+import difflib
+import hashlib
+import sqlite3
+import sys
+import time
+import zlib
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+# Add util to path for importing
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from util.paths import get_data_dir
+
+from app.catalog import normalize_path
+from app.config import REVISIONS_FILE, REVISION_SNAPSHOT_INTERVAL
+
+DATA_DIR = get_data_dir()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    hash TEXT PRIMARY KEY,
+    base TEXT,
+    depth INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    data BLOB NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS revisions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    path TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    action TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_revisions_path ON revisions(path, id);
+"""
+
+
+@contextmanager
+def _connect() -> Iterator[sqlite3.Connection]:
+    """Open a revision store connection, committing on success"""
+    conn = sqlite3.connect(REVISIONS_FILE, timeout=10)
+    conn.row_factory = sqlite3.Row
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def init_revisions() -> None:
+    """Create the revision store schema"""
+    REVISIONS_FILE.parent.mkdir(parents=True, exist_ok=True)
+    with _connect() as conn:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(SCHEMA)
+
+
+def _make_delta(base: bytes, data: bytes) -> bytes:
+    """Encode data as line copies from base plus inserted chunks"""
+    base_lines = base.splitlines(keepends=True)
+    lines = data.splitlines(keepends=True)
+    delta = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, base_lines, lines).get_opcodes():
+        if tag == 'equal':
+            delta.append(b'=%d %d\n' % (i1, i2))
+        elif j2 > j1:
+            chunk = b''.join(lines[j1:j2])
+            delta.append(b'+%d\n' % len(chunk) + chunk)
+    return b''.join(delta)
+
+
+def _apply_delta(base: bytes, delta: bytes) -> bytes:
+    """Rebuild content from base and a delta produced by _make_delta"""
+    base_lines = base.splitlines(keepends=True)
+    out = []
+    pos = 0
+    while pos < len(delta):
+        end = delta.index(b'\n', pos)
+        op, header = delta[pos:pos + 1], delta[pos + 1:end]
+        pos = end + 1
+        if op == b'=':
+            i1, i2 = map(int, header.split())
+            out.extend(base_lines[i1:i2])
+        else:
+            size = int(header)
+            out.append(delta[pos:pos + size])
+            pos += size
+    return b''.join(out)
+
+
+def _load(conn: sqlite3.Connection, content_hash: str) -> bytes:
+    """Load object content, applying at most REVISION_SNAPSHOT_INTERVAL deltas"""
+    chain = []
+    row = conn.execute('SELECT base, data FROM objects WHERE hash = ?', (content_hash,)).fetchone()
+    while row['base'] is not None:
+        chain.append(zlib.decompress(row['data']))
+        row = conn.execute('SELECT base, data FROM objects WHERE hash = ?', (row['base'],)).fetchone()
+
+    data = zlib.decompress(row['data'])
+    for delta in reversed(chain):
+        data = _apply_delta(data, delta)
+    return data
+
+
+def _store(conn: sqlite3.Connection, data: bytes, base_hash: str | None) -> str:
+    """Store content once by hash, as a delta against base_hash when that is smaller"""
+    content_hash = hashlib.sha256(data).hexdigest()
+    if conn.execute('SELECT 1 FROM objects WHERE hash = ?', (content_hash,)).fetchone():
+        return content_hash
+
+    snapshot = zlib.compress(data)
+    base = None
+    if base_hash is not None:
+        base = conn.execute('SELECT depth FROM objects WHERE hash = ?', (base_hash,)).fetchone()
+
+    if base is not None and base['depth'] + 1 < REVISION_SNAPSHOT_INTERVAL:
+        delta = zlib.compress(_make_delta(_load(conn, base_hash), data))
+        if len(delta) < len(snapshot):
+            conn.execute('INSERT INTO objects (hash, base, depth, size, data) VALUES (?, ?, ?, ?, ?)',
+                         (content_hash, base_hash, base['depth'] + 1, len(data), delta))
+            return content_hash
+
+    conn.execute('INSERT INTO objects (hash, base, depth, size, data) VALUES (?, NULL, 0, ?, ?)',
+                 (content_hash, len(data), snapshot))
+    return content_hash
+
+
+def record(rel_path: str, data: bytes, action: str = 'save') -> None:
+    """Record a new revision of a file unless it matches the latest one"""
+    rel_path = normalize_path(rel_path)
+    with _connect() as conn:
+        latest = conn.execute(
+            'SELECT hash, action FROM revisions WHERE path = ? ORDER BY id DESC LIMIT 1', (rel_path,)
+        ).fetchone()
+        if latest and action == 'save' and latest['action'] != 'delete' \
+                and latest['hash'] == hashlib.sha256(data).hexdigest():
+            return
+
+        content_hash = _store(conn, data, latest['hash'] if latest else None)
+        conn.execute('INSERT INTO revisions (path, hash, action, created) VALUES (?, ?, ?, ?)',
+                     (rel_path, content_hash, action, time.time()))
+
+
+def record_file(rel_path: str, action: str = 'save') -> None:
+    """Record the current on-disk content of a file, if it exists"""
+    file_path = DATA_DIR / rel_path
+    if file_path.is_file():
+        record(rel_path, file_path.read_bytes(), action)
+
+
+def history(rel_path: str) -> list[dict]:
+    """Get all revisions of a file, newest first"""
+    with _connect() as conn:
+        return [dict(row) for row in conn.execute(
+            'SELECT r.id, r.path, r.hash, r.action, r.created, o.size FROM revisions r '
+            'JOIN objects o ON o.hash = r.hash WHERE r.path = ? ORDER BY r.id DESC',
+            (normalize_path(rel_path),)
+        )]
+
+
+def deleted_files() -> list[dict]:
+    """Get files whose latest revision is a deletion"""
+    with _connect() as conn:
+        return [dict(row) for row in conn.execute(
+            'SELECT r.id, r.path, r.created FROM revisions r '
+            'WHERE r.id = (SELECT MAX(id) FROM revisions WHERE path = r.path) '
+            "AND r.action = 'delete' ORDER BY r.created DESC"
+        )]
+
+
+def get_revision(rev_id: int) -> dict | None:
+    """Get a revision with its content and a diff against the previous revision"""
+    with _connect() as conn:
+        row = conn.execute('SELECT * FROM revisions WHERE id = ?', (rev_id,)).fetchone()
+        if row is None:
+            return None
+
+        previous = conn.execute(
+            'SELECT hash FROM revisions WHERE path = ? AND id < ? ORDER BY id DESC LIMIT 1',
+            (row['path'], rev_id)
+        ).fetchone()
+        content = _load(conn, row['hash']).decode('utf-8', errors='replace')
+        old_content = _load(conn, previous['hash']).decode('utf-8', errors='replace') if previous else ''
+
+    diff = difflib.unified_diff(old_content.splitlines(), content.splitlines(),
+                                'previous', f'revision {rev_id}', lineterm='')
+    return {**dict(row), 'content': content, 'diff': '\n'.join(diff)}
+
+
+def load_revision(rev_id: int) -> tuple[str, bytes] | None:
+    """Get the path and raw content of a revision"""
+    with _connect() as conn:
+        row = conn.execute('SELECT path, hash FROM revisions WHERE id = ?', (rev_id,)).fetchone()
+        if row is None:
+            return None
+        return row['path'], _load(conn, row['hash'])
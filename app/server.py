@@ -1,23 +1,76 @@
+import hashlib
 import os
 import secrets
+import shutil
+import sqlite3
 import sys
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
+from typing import Iterator
 from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
 import markdown2
 from werkzeug.utils import secure_filename
 
+try:
+    import fcntl
+except ImportError:  # Windows: only threads of one process are serialized
+    fcntl = None
+
 # Add util to path for importing
 sys.path.insert(0, str(Path(__file__).parent.parent))
 from util.paths import get_data_dir, get_templates_dir, get_static_dir
 
+from app import catalog, revisions
 from app.auth import login_required, handle_login, handle_logout
-from app.config import ALLOWED_EXTENSIONS, SECRET_KEY, DEBUG, HOST, PORT, APP_NAME, APP_DESCRIPTION
+from app.config import (
+    ALLOWED_EXTENSIONS, MARKDOWN_EXTENSIONS, MARKDOWN_EXTRAS, RENDER_CACHE_SIZE,
+    PATCH_INPLACE_MAX_TAIL, FILE_LOCK_DIR,
+    SECRET_KEY, DEBUG, HOST, PORT, APP_NAME, APP_DESCRIPTION
+)
 
 # Use unified path management
 DATA_DIR = get_data_dir()
 TEMPLATES_DIR = get_templates_dir()
 STATIC_DIR = get_static_dir()
 
+# Per-file locks serializing writes between threads
+_file_locks: dict[str, threading.Lock] = {}
+_file_locks_guard = threading.Lock()
+
+
+@contextmanager
+def file_lock(rel_path: str) -> Iterator[None]:
+    """Serialize writes to a file across threads and, where fcntl exists, worker processes"""
+    rel_path = catalog.normalize_path(rel_path)
+    with _file_locks_guard:
+        lock = _file_locks.setdefault(rel_path, threading.Lock())
+    with lock:
+        if fcntl is None:
+            yield
+            return
+        lock_file = FILE_LOCK_DIR / f'{hashlib.sha256(rel_path.encode("utf-8")).hexdigest()}.lock'
+        with open(lock_file, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def write_atomic(file_path: Path, data: bytes) -> None:
+    """Replace a file's content through a temp file and os.replace, keeping its permission bits"""
+    temp_path = file_path.with_name(f'.{file_path.name}.tmp')
+    try:
+        temp_path.write_bytes(data)
+        if file_path.exists():
+            shutil.copymode(file_path, temp_path)
+        os.replace(temp_path, file_path)
+    finally:
+        temp_path.unlink(missing_ok=True)
+
 
 def create_app() -> Flask:
     """Create and configure Flask application"""
@@ -28,6 +81,10 @@ def create_app() -> Flask:
     app.secret_key = SECRET_KEY or secrets.token_hex(32)
     app.config['DEBUG'] = DEBUG
 
+    @app.template_filter('timestamp')
+    def format_timestamp(value: float) -> str:
+        return datetime.fromtimestamp(value).strftime('%Y-%m-%d %H:%M:%S')
+
     # Make app configuration available to all templates
     @app.context_processor
     def inject_app_config():
@@ -36,29 +93,6 @@ def create_app() -> Flask:
             'APP_DESCRIPTION': APP_DESCRIPTION
         }
 
-    def get_file_tree(directory: Path, base_path: str = "") -> list[dict]:
-        """Get file tree structure"""
-        items = []
-        try:
-            for item in sorted(directory.iterdir()):
-                if item.is_file() and item.suffix.lower() in ALLOWED_EXTENSIONS:
-                    items.append({
-                        'type': 'file',
-                        'name': item.name,
-                        'path': os.path.join(base_path, item.name).replace('\\', '/'),
-                        'size': item.stat().st_size
-                    })
-                elif item.is_dir() and not item.name.startswith('.'):
-                    items.append({
-                        'type': 'directory',
-                        'name': item.name,
-                        'path': os.path.join(base_path, item.name).replace('\\', '/'),
-                        'children': get_file_tree(item, os.path.join(base_path, item.name))
-                    })
-        except PermissionError:
-            pass
-        return items
-
     def search_files(query: str) -> list[dict]:
         """Search files by content and filename"""
         results = []
@@ -106,6 +140,45 @@ def create_app() -> Flask:
         search_directory(DATA_DIR)
         return results
 
+    @lru_cache(maxsize=RENDER_CACHE_SIZE)
+    def render_block(block: str, refs: str = '') -> str:
+        """Render a single top-level Markdown block with the note's link definitions, cached by both"""
+        return markdown2.markdown(f'{block}\n\n{refs}' if refs else block, extras=MARKDOWN_EXTRAS)
+
+    def sync_catalog(rel_path: str) -> None:
+        """Refresh the catalog after a write; a catalog failure never fails the write itself"""
+        try:
+            if (DATA_DIR / rel_path).is_file():
+                catalog.update_file(rel_path)
+            else:
+                catalog.remove_file(rel_path)
+        except sqlite3.Error:
+            # The size/mtime mismatch lets the next reconcile repair the entry
+            app.logger.exception('Catalog update failed for %s', rel_path)
+
+    def apply_edits(text: str, edits: list) -> tuple[str, int]:
+        """Apply non-overlapping offset/length/replacement edits, returning new text and first changed offset"""
+        for edit in edits:
+            if not (isinstance(edit, dict)
+                    and isinstance(edit.get('offset'), int)
+                    and isinstance(edit.get('length'), int)
+                    and isinstance(edit.get('replacement'), str)):
+                raise ValueError('Each edit needs an integer offset and length and a string replacement')
+        
+        parts = []
+        pos = 0
+        for edit in sorted(edits, key=lambda e: e['offset']):
+            offset, length = edit['offset'], edit['length']
+            if offset < pos or length < 0 or offset + length > len(text):
+                raise ValueError('Edits are out of range or overlapping')
+            parts.append(text[pos:offset])
+            parts.append(edit['replacement'])
+            pos = offset + length
+        parts.append(text[pos:])
+        
+        first_offset = min((edit['offset'] for edit in edits), default=len(text))
+        return ''.join(parts), first_offset
+
     def allowed_file(filename: str) -> bool:
         """Check if file extension is allowed"""
         return Path(filename).suffix.lower() in ALLOWED_EXTENSIONS
@@ -122,8 +195,18 @@ def create_app() -> Flask:
     @app.route('/')
     @login_required
     def index():
-        file_tree = get_file_tree(DATA_DIR)
-        return render_template('index.html', file_tree=file_tree)
+        try:
+            catalog.reconcile_if_stale()
+        except sqlite3.Error:
+            app.logger.exception('Catalog reconcile failed')
+        return render_template('index.html',
+                             file_tree=catalog.get_file_tree(),
+                             recent_files=catalog.recent_files())
+
+    @app.route('/tag/<path:tag>')
+    @login_required
+    def tag_files(tag: str):
+        return render_template('tag.html', tag=tag, files=catalog.files_with_tag(tag))
 
     @app.route('/view/<path:filepath>')
     @login_required
@@ -138,21 +221,21 @@ def create_app() -> Flask:
             with open(file_path, 'r', encoding='utf-8') as f:
                 content = f.read()
             
-            if file_path.suffix.lower() in ['.md', '.markdown']:
-                html_content = markdown2.markdown(
-                    content, 
-                    extras=['fenced-code-blocks', 'tables', 'code-friendly']
-                )
+            if file_path.suffix.lower() in MARKDOWN_EXTENSIONS:
+                html_content = markdown2.markdown(content, extras=MARKDOWN_EXTRAS)
                 return render_template('viewer.html', 
                                      content=html_content, 
                                      filename=file_path.name,
                                      filepath=filepath,
+                                     tags=catalog.file_tags(filepath),
+                                     backlinks=catalog.backlinks(filepath),
                                      is_markdown=True)
             else:
                 return render_template('viewer.html', 
                                      content=content, 
                                      filename=file_path.name,
                                      filepath=filepath,
+                                     backlinks=catalog.backlinks(filepath),
                                      is_markdown=False)
         except UnicodeDecodeError:
             flash('Unable to decode file content', 'error')
@@ -168,12 +251,13 @@ def create_app() -> Flask:
             return redirect(url_for('index'))
         
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
+            data = file_path.read_bytes()
+            content = data.decode('utf-8').replace('\r\n', '\n')
             return render_template('edit.html', 
                                  content=content, 
                                  filename=file_path.name,
-                                 filepath=filepath)
+                                 filepath=filepath,
+                                 base_hash=hashlib.sha256(data).hexdigest())
         except UnicodeDecodeError:
             flash('Unable to decode file content', 'error')
             return redirect(url_for('index'))
@@ -183,19 +267,129 @@ def create_app() -> Flask:
     def save_file(filepath: str):
         file_path = DATA_DIR / filepath
         content = request.form.get('content', '')
+        base = request.form.get('base', '')
         
         try:
             # Ensure directory exists
             file_path.parent.mkdir(parents=True, exist_ok=True)
             
-            with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(content)
+            with file_lock(filepath):
+                if base and file_path.is_file():
+                    current_hash = hashlib.sha256(file_path.read_bytes()).hexdigest()
+                    if current_hash != base:
+                        flash('File changed since it was loaded. Save again to overwrite it with your version.', 'error')
+                        return render_template('edit.html',
+                                             content=content,
+                                             filename=file_path.name,
+                                             filepath=filepath,
+                                             base_hash=current_hash,
+                                             conflict=True), 409
+                
+                # Keep any version written outside the app before overwriting it
+                revisions.record_file(filepath)
+                
+                with open(file_path, 'w', encoding='utf-8') as f:
+                    f.write(content)
+                revisions.record(filepath, file_path.read_bytes())
+            sync_catalog(filepath)
             flash('File saved successfully', 'success')
         except Exception as e:
             flash(f'Error saving file: {str(e)}', 'error')
         
         return redirect(url_for('view_file', filepath=filepath))
 
+    @app.route('/patch/<path:filepath>', methods=['POST'])
+    @login_required
+    def patch_file(filepath: str):
+        file_path = DATA_DIR / filepath
+        data = request.get_json(silent=True)
+        
+        if not isinstance(data, dict):
+            return jsonify({'error': 'Request body must be a JSON object'}), 400
+        edits = data.get('edits')
+        if not isinstance(edits, list):
+            return jsonify({'error': 'Edits must be a list'}), 400
+        
+        with file_lock(filepath):
+            if not file_path.exists() or not file_path.is_file():
+                return jsonify({'error': 'File not found'}), 404
+            
+            old_data = file_path.read_bytes()
+            old_hash = hashlib.sha256(old_data).hexdigest()
+            if data.get('base') != old_hash:
+                # Send the current text so the client can re-base instead of diffing against stale text
+                return jsonify({
+                    'error': 'File changed since it was loaded',
+                    'hash': old_hash,
+                    'content': old_data.decode('utf-8', errors='replace').replace('\r\n', '\n')
+                }), 409
+            if not edits:
+                flash('File saved successfully', 'success')
+                return jsonify({'hash': old_hash})
+            
+            try:
+                text = old_data.decode('utf-8')
+                # Offsets refer to the text as shown in the editor, with '\n' line endings
+                normalized = text.replace('\r\n', '\n')
+                new_text, first_offset = apply_edits(normalized, edits)
+            except UnicodeDecodeError:
+                return jsonify({'error': 'Unable to decode file content'}), 400
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            
+            new_data = new_text.encode('utf-8')
+            if new_data == old_data:
+                flash('File saved successfully', 'success')
+                return jsonify({'hash': old_hash})
+            
+            try:
+                # Keep any version written outside the app before overwriting it
+                revisions.record(filepath, old_data)
+                
+                start = len(normalized[:first_offset].encode('utf-8'))
+                tail = new_data[start:]
+                if normalized == text and len(tail) <= PATCH_INPLACE_MAX_TAIL:
+                    with open(file_path, 'r+b') as f:
+                        f.seek(start)
+                        f.write(tail)
+                        f.truncate()
+                else:
+                    write_atomic(file_path, new_data)
+                
+                revisions.record(filepath, new_data)
+                sync_catalog(filepath)
+            except Exception as e:
+                return jsonify({'error': f'Error saving file: {str(e)}'}), 500
+        
+        flash('File saved successfully', 'success')
+        return jsonify({'hash': hashlib.sha256(new_data).hexdigest()})
+
+    @app.route('/preview', methods=['POST'])
+    @login_required
+    def preview():
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({'error': 'Request body must be a JSON object'}), 400
+        
+        start = data.get('start')
+        end = data.get('end')
+        blocks = data.get('blocks')
+        refs = data.get('refs', '')
+        
+        if not isinstance(start, int) or not isinstance(end, int) or not 0 <= start <= end:
+            return jsonify({'error': 'Invalid block range'}), 400
+        if not isinstance(blocks, list) or not all(isinstance(block, str) for block in blocks):
+            return jsonify({'error': 'Blocks must be a list of strings'}), 400
+        if not isinstance(refs, str):
+            return jsonify({'error': 'Refs must be a string'}), 400
+        
+        return jsonify({
+            'start': start,
+            'end': end,
+            # Only blocks that can contain a link reference depend on the definitions
+            'html': [render_block(block, refs if '[' in block else '') for block in blocks]
+        })
+
     @app.route('/new')
     @login_required
     def new_file():
@@ -228,20 +422,23 @@ def create_app() -> Flask:
         else:
             file_path = DATA_DIR / filename
         
-        if file_path.exists():
-            flash('File already exists', 'error')
-            return render_template('edit.html', content=content, filename=filename, filepath='')
-        
+        relative_path = str(file_path.relative_to(DATA_DIR)).replace('\\', '/')
         try:
             # Ensure directory exists
             file_path.parent.mkdir(parents=True, exist_ok=True)
             
-            with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(content)
+            with file_lock(relative_path):
+                if file_path.exists():
+                    flash('File already exists', 'error')
+                    return render_template('edit.html', content=content, filename=filename, filepath='')
+                
+                with open(file_path, 'w', encoding='utf-8') as f:
+                    f.write(content)
+                revisions.record(relative_path, file_path.read_bytes())
+            sync_catalog(relative_path)
             flash('File created successfully', 'success')
             
-            relative_path = file_path.relative_to(DATA_DIR)
-            return redirect(url_for('view_file', filepath=str(relative_path).replace('\\', '/')))
+            return redirect(url_for('view_file', filepath=relative_path))
         except Exception as e:
             flash(f'Error creating file: {str(e)}', 'error')
             return render_template('edit.html', content=content, filename=filename, filepath='')
@@ -271,7 +468,12 @@ def create_app() -> Flask:
                 # Ensure directory exists
                 file_path.parent.mkdir(parents=True, exist_ok=True)
                 
-                file.save(file_path)
+                relative_path = str(file_path.relative_to(DATA_DIR)).replace('\\', '/')
+                with file_lock(relative_path):
+                    revisions.record_file(relative_path)
+                    file.save(file_path)
+                    revisions.record(relative_path, file_path.read_bytes())
+                sync_catalog(relative_path)
                 flash('File uploaded successfully', 'success')
             except Exception as e:
                 flash(f'Error uploading file: {str(e)}', 'error')
@@ -280,6 +482,54 @@ def create_app() -> Flask:
         
         return redirect(url_for('index'))
 
+    @app.route('/links/broken')
+    @login_required
+    def broken_links():
+        return render_template('broken_links.html', links=catalog.broken_links())
+
+    @app.route('/history')
+    @app.route('/history/<path:filepath>')
+    @login_required
+    def file_history(filepath: str = ''):
+        if filepath:
+            return render_template('history.html', filepath=filepath,
+                                 revisions=revisions.history(filepath))
+        return render_template('history.html', filepath='',
+                             revisions=revisions.deleted_files())
+
+    @app.route('/revision/<int:rev_id>')
+    @login_required
+    def view_revision(rev_id: int):
+        revision = revisions.get_revision(rev_id)
+        if revision is None:
+            flash('Revision not found', 'error')
+            return redirect(url_for('index'))
+        return render_template('revision.html', revision=revision)
+
+    @app.route('/restore/<int:rev_id>', methods=['POST'])
+    @login_required
+    def restore_revision(rev_id: int):
+        revision = revisions.load_revision(rev_id)
+        if revision is None:
+            flash('Revision not found', 'error')
+            return redirect(url_for('index'))
+        
+        filepath, data = revision
+        file_path = DATA_DIR / filepath
+        try:
+            file_path.parent.mkdir(parents=True, exist_ok=True)
+            with file_lock(filepath):
+                # Keep any version written outside the app before overwriting it
+                revisions.record_file(filepath)
+                write_atomic(file_path, data)
+                revisions.record(filepath, data, 'restore')
+            sync_catalog(filepath)
+            flash('Revision restored successfully', 'success')
+        except Exception as e:
+            flash(f'Error restoring revision: {str(e)}', 'error')
+        
+        return redirect(url_for('view_file', filepath=filepath))
+
     @app.route('/search')
     @login_required
     def search():
@@ -301,7 +551,10 @@ def create_app() -> Flask:
             return redirect(url_for('index'))
         
         try:
-            file_path.unlink()
+            with file_lock(filepath):
+                revisions.record_file(filepath, 'delete')
+                file_path.unlink()
+            sync_catalog(filepath)
             flash('File deleted successfully', 'success')
         except Exception as e:
             flash(f'Error deleting file: {str(e)}', 'error')
@@ -310,5 +563,8 @@ def create_app() -> Flask:
 
     # Ensure data directory exists
     DATA_DIR.mkdir(exist_ok=True)
+    catalog.init_catalog()
+    revisions.init_revisions()
+    FILE_LOCK_DIR.mkdir(parents=True, exist_ok=True)
     
     return app
\ No newline at end of file
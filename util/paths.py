@@ -35,6 +35,11 @@ def get_data_dir() -> Path:
     return get_project_root() / "data"
 
 
+def get_meta_dir() -> Path:
+    """获取笔记元数据目录路径（数据目录下的隐藏目录）"""
+    return get_data_dir() / ".notebook"
+
+
 def get_temp_dir() -> Path:
     """获取临时文件目录路径"""
     return get_project_root() / "temp"
@@ -113,6 +118,7 @@ def get_relative_path(file_path: Union[str, Path], base_path: Union[str, Path] =
 PROJECT_ROOT = get_project_root()
 CONFIG_DIR = get_config_dir()
 DATA_DIR = get_data_dir()
+META_DIR = get_meta_dir()
 TEMP_DIR = get_temp_dir()
 TEMPLATES_DIR = get_templates_dir()
 STATIC_DIR = get_static_dir()